@@ -1,9 +1,29 @@
 import streamlit as st
-import requests
+import httpx
+import asyncio
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
-from moviepy.editor import ImageSequenceClip, AudioFileClip, CompositeVideoClip, TextClip
-from moviepy.video.tools.subtitles import SubtitlesClip
+import tempfile
+import json
+import re
+import base64
+import io
+import orjson
+import time
+import random
+import subprocess
+import hashlib
+import functools
+import shutil
+import threading
+import mimetypes
+import logging
+import diskcache
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 # Access credentials from secrets.toml (Managed by Streamlit)
 openai_api_key = st.secrets["OPENAI_API_KEY"]
@@ -12,36 +32,399 @@ aws_secret_access_key = st.secrets["AWS_SECRET_ACCESS_KEY"]
 aws_region = st.secrets["AWS_REGION"]
 aws_s3_bucket_name = st.secrets["AWS_S3_BUCKET_NAME"]
 
-# Set up AWS S3 client
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id=aws_access_key_id,
-    aws_secret_access_key=aws_secret_access_key,
-    region_name=aws_region
+# Set up AWS S3 client once per server process rather than on every Streamlit rerun
+@st.cache_resource
+def get_s3():
+    return boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        region_name=aws_region,
+        config=Config(max_pool_connections=50, retries={'max_attempts': 5, 'mode': 'adaptive'})
+    )
+
+# Multipart settings for S3 uploads: 8 MiB parts sent over up to 10 threads
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
 )
 
 # OpenAI API URLs
 IMAGE_API_URL = "https://api.openai.com/v1/images/generations"
 TTS_API_URL = "https://api.openai.com/v1/audio/speech"
 CHAT_API_URL = "https://api.openai.com/v1/chat/completions"
+EMBEDDINGS_API_URL = "https://api.openai.com/v1/embeddings"
+FILES_API_URL = "https://api.openai.com/v1/files"
+BATCHES_API_URL = "https://api.openai.com/v1/batches"
 HEADERS = {"Authorization": f"Bearer {openai_api_key}"}
 
+# Server-side log on stderr; set up once per process so reruns don't stack handlers
+@st.cache_resource
+def get_logger():
+    logger = logging.getLogger("storyvideoai")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
+    return logger
+
+# Verbose progress always goes to the log, and to the page only when "Debug logs" is ticked
+def debug_log(message):
+    get_logger().info(message)
+    if st.session_state.get("debug"):
+        st.write(message)
+
 AVAILABLE_VOICES = ["alloy", "echo", "fable", "onyx", "nova", "shimmer"]
 
-# Helper function to upload to S3
-def upload_to_s3(filename):
+# Maximum number of DALL-E requests in flight at once (tier rate limit)
+IMAGE_CONCURRENCY = 5
+
+# Upper bound on pooled connections to api.openai.com per run; HTTP/2 multiplexes
+# concurrent requests over one connection, so usually only a single one is opened
+MAX_CONNECTIONS = 10
+
+# Upper bound on OpenAI requests in flight per run across all endpoints; with HTTP/2 the
+# connection limit no longer caps this, and bursts beyond it only end in 429 backoff
+MAX_CONCURRENT_REQUESTS = 8
+
+# DALL-E model, image size and prompt length limit for final renders and for cheaper, faster drafts
+IMAGE_SETTINGS = {
+    "final": ("dall-e-3", "1024x1024", 4000),
+    "draft": ("dall-e-2", "512x512", 1000),
+}
+
+# Output video is square; DALL-E's images are scaled to this size before encoding
+VIDEO_SIZE = 720
+
+# Output frame rate, set by the fps filter ahead of subtitles in compile_video. The video is a
+# slideshow of stills, so a low rate shortens the encode while subtitle changes still land
+# within 1/VIDEO_FPS seconds
+VIDEO_FPS = 5
+
+# Shown when the ffmpeg or ffprobe binary can't be run; packages.txt installs both on Streamlit
+# Community Cloud
+FFMPEG_MISSING_ERROR = "ffmpeg was not found. Install ffmpeg (with ffprobe and libass) and make sure it is on PATH."
+
+# Persistent cache for OpenAI responses; bump CACHE_VERSION to invalidate it
+CACHE_VERSION = "v1"
+
+# Open the cache once per server process rather than on every Streamlit rerun
+@st.cache_resource
+def get_cache():
+    return diskcache.Cache("./.cache")
+
+# Texts at least this similar (cosine) to an earlier text reuse its cached responses
+IMAGE_SIMILARITY_THRESHOLD = 0.98
+STORY_SIMILARITY_THRESHOLD = 0.95
+
+# Most texts remembered per semantic cache namespace; the oldest are evicted beyond this
+SEMANTIC_INDEX_MAX_ENTRIES = 5000
+
+# Embeddings of earlier texts for the semantic cache. They are persisted in a diskcache Index
+# keyed by namespace and text hash, and kept in memory as one normalized matrix per namespace
+# so a lookup is a single matrix product instead of unpickling every stored entry
+class SemanticIndex:
+    def __init__(self, path):
+        self.index = diskcache.Index(path)
+        # Sessions run on separate threads but share this object
+        self.lock = threading.Lock()
+        self.keys, self.texts, self.embeddings = {}, {}, {}
+        for key, entry in self.index.items():
+            namespace = entry["namespace"]
+            self.keys.setdefault(namespace, []).append(key)
+            self.texts.setdefault(namespace, []).append(entry["text"])
+            self.embeddings.setdefault(namespace, []).append(entry["embedding"])
+        self.embeddings = {namespace: np.stack(rows) for namespace, rows in self.embeddings.items()}
+
+    # Text in namespace most similar to a normalized embedding, or None below threshold
+    def find(self, namespace, embedding, threshold):
+        with self.lock:
+            matrix = self.embeddings.get(namespace)
+            if matrix is None:
+                return None
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            return self.texts[namespace][best] if similarities[best] >= threshold else None
+
+    # Remember a text and its normalized embedding, evicting the namespace's oldest entries
+    def add(self, namespace, text, embedding):
+        key = make_cache_key(f"semantic:{namespace}", text=text)
+        with self.lock:
+            self.index[key] = {"namespace": namespace, "text": text, "embedding": embedding}
+            keys = self.keys.setdefault(namespace, [])
+            texts = self.texts.setdefault(namespace, [])
+            keys.append(key)
+            texts.append(text)
+            matrix = self.embeddings.get(namespace)
+            matrix = embedding[np.newaxis] if matrix is None else np.vstack([matrix, embedding])
+
+            overflow = len(keys) - SEMANTIC_INDEX_MAX_ENTRIES
+            if overflow > 0:
+                for old_key in keys[:overflow]:
+                    self.index.pop(old_key, None)
+                del keys[:overflow]
+                del texts[:overflow]
+                matrix = matrix[overflow:]
+            self.embeddings[namespace] = matrix
+
+# Load the semantic cache once per server process rather than on every Streamlit rerun
+@st.cache_resource
+def get_semantic_index():
+    return SemanticIndex("./.cache/semantic")
+
+# Build a cache key from a namespace and the request parameters
+def make_cache_key(namespace, **params):
+    payload = json.dumps({"version": CACHE_VERSION, "namespace": namespace, **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+# Cache key of a call to a function decorated with cached(namespace), without its client
+def call_cache_key(namespace, *args, **kwargs):
+    return make_cache_key(namespace, args=args, kwargs=kwargs)
+
+# Decorator caching the result of an API coroutine on disk, keyed on everything but the client
+def cached(namespace):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(client, *args, **kwargs):
+            key = call_cache_key(namespace, *args, **kwargs)
+            result = get_cache().get(key)
+            if result is None:
+                result = await func(client, *args, **kwargs)
+                get_cache().set(key, result)
+            return result
+        return wrapper
+    return decorator
+
+# Per-endpoint (requests per minute, tokens per minute) budgets; None means no token budget.
+# Defaults follow OpenAI's usage tier 1, adjust them to the account's tier
+RATE_LIMITS = {
+    CHAT_API_URL: (500, 200000),
+    IMAGE_API_URL: (5, None),
+    TTS_API_URL: (50, None),
+    EMBEDDINGS_API_URL: (3000, 1000000),
+}
+# Rate limits and transient server errors are retried with jittered exponential backoff
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BACKOFF = 0.5
+MAX_RETRIES = 5
+MAX_RETRY_SLEEP = 60
+
+# Seconds allowed to connect to the API and to wait on any single read or write
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 120
+
+# Chunk size for streaming binary responses to disk
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Longest pause between status checks of a Batch API job
+BATCH_POLL_MAX_SLEEP = 300
+
+# Rough token count of a request body for the tokens-per-minute budget (~4 characters per token)
+def estimate_tokens(data):
+    return len(json.dumps(data)) // 4
+
+# Token bucket enforcing a requests-per-minute and tokens-per-minute budget. The bucket is
+# shared by every run in the server process (see get_rate_limiters), so its state is guarded by
+# a thread lock and each caller only waits on its own event loop
+class RateLimiter:
+    def __init__(self, rpm, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = rpm
+        self.available_tokens = tpm or 0
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+
+    # Take one request of the given size from the budget, going into debt when it is spent, and
+    # return the seconds until the debt is repaid; later callers queue behind earlier ones
+    def _reserve(self, tokens):
+        with self.lock:
+            self._refill()
+            self.available_requests -= 1
+            self.available_tokens -= tokens
+            wait = -self.available_requests * 60 / self.rpm
+            if self.tpm:
+                wait = max(wait, -self.available_tokens * 60 / self.tpm)
+            return wait
+
+    # Wait until the budget allows one request of the given size
+    async def acquire(self, tokens=0):
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+# Rate limiters for RATE_LIMITS, created once per server process so the budgets hold across
+# runs and sessions rather than starting full on every run
+@st.cache_resource
+def get_rate_limiters():
+    return {url: RateLimiter(rpm, tpm) for url, (rpm, tpm) in RATE_LIMITS.items()}
+
+# Seconds to wait from OpenAI's retry-after-ms or retry-after header, or None when absent or unparseable
+def _retry_after(headers):
     try:
-        s3_key = f"generated_files/{filename}"
-        s3_client.upload_file(filename, aws_s3_bucket_name, s3_key)
-        file_url = f"https://{aws_s3_bucket_name}.s3.{aws_region}.amazonaws.com/{s3_key}"
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+# Seconds to wait before retry number attempt + 1: the server's hint when it gave one, else an
+# exponential backoff with full jitter, capped at MAX_RETRY_SLEEP
+def _retry_delay(retry_after, attempt):
+    delay = retry_after if retry_after is not None else random.uniform(0, RETRY_BACKOFF * 2 ** (attempt + 1))
+    return min(delay, MAX_RETRY_SLEEP)
+
+# HTTP session shared by every OpenAI call in a run, paced by the process-wide rate limiters
+class OpenAIClient:
+    def __init__(self, session):
+        self.session = session
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        self.limiters = get_rate_limiters()
+        # Background S3 uploads of newly generated shared assets, keyed by S3 key
+        self.asset_uploads = {}
+
+    # POST JSON data (or multipart form fields, in httpx's files format) to an OpenAI endpoint
+    # within its rate limit and return the raw response body, or stream it into filename when
+    # given. RETRY_STATUSES are retried after Retry-After, or an exponential backoff with full
+    # jitter so concurrent callers don't retry in lockstep, capped at MAX_RETRY_SLEEP
+    async def post(self, url, data=None, form=None, filename=None):
+        limiter = self.limiters.get(url)
+        for attempt in range(MAX_RETRIES + 1):
+            if limiter:
+                await limiter.acquire(tokens=estimate_tokens(data))
+            # The rate limit is waited for before taking a slot, so waiting requests hold none
+            async with self.semaphore, self.session.stream("POST", url, json=data, files=form) as response:
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    if filename is None:
+                        return await response.aread()
+                    with open(filename, "wb") as f:
+                        async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                            f.write(chunk)
+                    return filename
+                retry_after = _retry_after(response.headers)
+            await asyncio.sleep(_retry_delay(retry_after, attempt))
+
+    # GET from an OpenAI endpoint and return the raw response body. Retried like post, and as
+    # a GET is safe to repeat, connection errors and timeouts are retried too
+    async def get(self, url):
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    response = await self.session.get(url)
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    response.raise_for_status()
+                    return response.content
+                retry_after = _retry_after(response.headers)
+            except httpx.TransportError:
+                if attempt == MAX_RETRIES:
+                    raise
+            await asyncio.sleep(_retry_delay(retry_after, attempt))
+
+# Upload a file to S3 and return its URL; touches no Streamlit state so it can run on worker threads
+def _upload_file(filename):
+    s3_key = f"generated_files/{filename}"
+    content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    get_s3().upload_file(
+        filename, aws_s3_bucket_name, s3_key,
+        Config=S3_TRANSFER_CONFIG,
+        ExtraArgs={"ContentType": content_type}
+    )
+    return f"https://{aws_s3_bucket_name}.s3.{aws_region}.amazonaws.com/{s3_key}"
+
+# Start uploading files to S3 in the background; the boto3 client is shared across threads
+def start_uploads(files):
+    executor = ThreadPoolExecutor(max_workers=16)
+    futures = {filename: executor.submit(_upload_file, filename) for filename in files}
+    executor.shutdown(wait=False)
+    return futures
+
+# Wait for a background upload and report the result from the script thread
+def finish_upload(filename, future):
+    try:
+        file_url = future.result()
         st.write(f"Uploaded {filename} to S3: {file_url}")
         return file_url
     except Exception as e:
         st.error(f"Failed to upload {filename} to S3: {e}")
         return None
 
+# Generated assets are shared between sessions in S3 under the hash of the request that
+# produced them, so a key always holds the same content and may be cached forever. The
+# credentials need s3:GetObject and s3:PutObject on assets/*; without s3:ListBucket S3
+# answers 403 instead of 404 for an asset that doesn't exist yet
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# S3 key of the shared asset for a request, addressed by its SHA-256
+def asset_key(namespace, extension, **params):
+    return f"assets/{namespace}/{make_cache_key(namespace, **params)}{extension}"
+
+# Download a shared asset into fileobj; returns False when it has not been generated yet
+def _download_asset(key, fileobj):
+    try:
+        get_s3().download_fileobj(aws_s3_bucket_name, key, fileobj, Config=S3_TRANSFER_CONFIG)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("403", "404", "NoSuchKey"):
+            return False
+        raise
+
+# Upload a shared asset from the file object open_body returns
+def _upload_asset(key, open_body, content_type):
+    with open_body() as body:
+        get_s3().upload_fileobj(
+            body, aws_s3_bucket_name, key,
+            Config=S3_TRANSFER_CONFIG,
+            ExtraArgs={"ContentType": content_type, "CacheControl": ASSET_CACHE_CONTROL}
+        )
+
+# Thread pool for background shared asset uploads, created once per server process
+@st.cache_resource
+def get_asset_upload_executor():
+    return ThreadPoolExecutor(max_workers=8)
+
+# Look up a shared asset without blocking the event loop; S3 errors count as a miss
+async def fetch_shared_asset(key, fileobj):
+    try:
+        return await asyncio.to_thread(_download_asset, key, fileobj)
+    except Exception as e:
+        st.warning(f"Shared asset lookup failed for {key}: {str(e)}")
+        return False
+
+# Start storing a shared asset in the background, so the request that generated it doesn't
+# wait on the upload; the run collects it with finish_shared_assets
+def store_shared_asset(client, key, open_body, content_type):
+    client.asset_uploads[key] = get_asset_upload_executor().submit(_upload_asset, key, open_body, content_type)
+
+# Wait for a run's shared asset uploads; failures only cost later sessions a regeneration
+def finish_shared_assets(asset_uploads):
+    for key, future in asset_uploads.items():
+        try:
+            future.result()
+        except Exception as e:
+            st.warning(f"Failed to share asset {key}: {str(e)}")
+
+# Send a chat completion request and return the message content
+@cached("chat")
+async def _chat_completion(client, data):
+    response = orjson.loads(await client.post(CHAT_API_URL, data))
+    return response['choices'][0]['message']['content']
+
 # Function to enhance the user prompt
-def enhance_prompt(prompt):
+async def enhance_prompt(client, prompt):
     try:
         data = {
             "model": "gpt-4o-mini",
@@ -49,11 +432,9 @@ def enhance_prompt(prompt):
                 {"role": "user", "content": f"Enhance the following prompt for a story video: {prompt}"}
             ]
         }
-        response = requests.post(CHAT_API_URL, headers=HEADERS, json=data)
-        response.raise_for_status()
-        enhanced_prompt = response.json()['choices'][0]['message']['content']
+        enhanced_prompt = await _chat_completion(client, data)
         return enhanced_prompt
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         st.error(f"Error enhancing prompt: {http_err}")
         return prompt
     except Exception as e:
@@ -61,7 +442,7 @@ def enhance_prompt(prompt):
         return prompt
 
 # Function to generate a consistent style prompt based on the enhanced prompt
-def generate_style_prompt(enhanced_prompt):
+async def generate_style_prompt(client, enhanced_prompt):
     try:
         data = {
             "model": "gpt-4o-mini",
@@ -69,19 +450,25 @@ def generate_style_prompt(enhanced_prompt):
                 {"role": "user", "content": f"Generate a comma-separated list of style and setting descriptions for images based on the following enhanced prompt: {enhanced_prompt}"}
             ]
         }
-        response = requests.post(CHAT_API_URL, headers=HEADERS, json=data)
-        response.raise_for_status()
-        style_prompt = response.json()['choices'][0]['message']['content']
+        style_prompt = await _chat_completion(client, data)
         return style_prompt
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         st.error(f"Error generating style prompt: {http_err}")
         return ""
     except Exception as e:
         st.error(f"Error: {str(e)}")
         return ""
 
+# Numbered-list prefix such as "1. " that the model may put in front of a segment
+_NUM_PREFIX = re.compile(r'^\s*\d+\.(?!\d)\s*')
+
+# Strip list numbering and drop empty segments, keeping at most 5
+def clean_story_segments(story_segments):
+    cleaned_segments = [_NUM_PREFIX.sub('', segment).strip() for segment in story_segments]
+    return [segment for segment in cleaned_segments if segment][:5]
+
 # Function to generate story segments from the enhanced prompt
-def generate_story_segments(enhanced_prompt):
+async def generate_story_segments(client, enhanced_prompt):
     try:
         data = {
             "model": "gpt-4o-mini",
@@ -89,135 +476,579 @@ def generate_story_segments(enhanced_prompt):
                 {"role": "user", "content": f"Create a short story with a maximum of 5 segments from the following prompt: {enhanced_prompt}"}
             ]
         }
-        response = requests.post(CHAT_API_URL, headers=HEADERS, json=data)
-        response.raise_for_status()
-        story = response.json()['choices'][0]['message']['content']
-        return story.split("\n")[:5]
-    except requests.exceptions.HTTPError as http_err:
+        story = await _chat_completion(client, data)
+        return clean_story_segments(story.split("\n"))
+    except httpx.HTTPStatusError as http_err:
         st.error(f"Error generating story: {http_err}")
         return []
     except Exception as e:
         st.error(f"Error: {str(e)}")
         return []
 
-# Function to create a consistent image prompt
-def create_image_prompt(segment, style_prompt):
+# Submit chat completion bodies, keyed by custom_id, as one Batch API job and return its id
+async def submit_batch(client, jobs):
+    lines = [
+        orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+        for custom_id, body in jobs.items()
+    ]
+    form = {
+        "purpose": (None, "batch"),
+        "file": ("batch.jsonl", b"\n".join(lines), "application/jsonl")
+    }
+    input_file = orjson.loads(await client.post(FILES_API_URL, form=form))
+
+    data = {"input_file_id": input_file["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"}
+    batch = orjson.loads(await client.post(BATCHES_API_URL, data))
+    return batch["id"]
+
+# Describe why a Batch API job has no results, from its errors and its error file
+async def describe_batch_error(client, batch):
+    messages = [error.get("message", "") for error in (batch.get("errors") or {}).get("data", [])]
+    if batch.get("error_file_id"):
+        output = await client.get(f"{FILES_API_URL}/{batch['error_file_id']}/content")
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response_body = (result.get("response") or {}).get("body") or {}
+            error = result.get("error") or response_body.get("error") or {}
+            messages.append(error.get("message", ""))
+    return "; ".join(message for message in messages if message) or "no error details"
+
+# Poll a Batch API job with exponential backoff and return the response bodies keyed by custom_id
+async def wait_for_batch(client, batch_id):
+    delay = 5
+    while True:
+        # The batch keeps running (and is billed) regardless, so a network or server error
+        # during the long wait means polling again later rather than giving up on it
+        try:
+            batch = orjson.loads(await client.get(f"{BATCHES_API_URL}/{batch_id}"))
+        except httpx.TransportError as e:
+            debug_log(f"Polling batch {batch_id} failed, trying again: {e}")
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRY_STATUSES:
+                raise
+            debug_log(f"Polling batch {batch_id} failed, trying again: {e}")
+        else:
+            if batch["status"] == "completed":
+                break
+            if batch["status"] in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"Batch {batch_id} {batch['status']}: {await describe_batch_error(client, batch)}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_SLEEP)
+
+    # output_file_id is null when every request in the batch failed
+    results = {}
+    if batch.get("output_file_id"):
+        output = await client.get(f"{FILES_API_URL}/{batch['output_file_id']}/content")
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response")
+            if response and response["status_code"] == 200:
+                results[result["custom_id"]] = response["body"]
+    if not results:
+        raise RuntimeError(f"Batch {batch_id} returned no results: {await describe_batch_error(client, batch)}")
+    return results
+
+# Run a single chat completion through the Batch API (half price, finishes within 24 hours).
+# The batch id is kept on disk so a rerun resumes waiting instead of paying for a new batch,
+# and the answer is cached where _chat_completion would have stored it
+async def batch_chat_completion(client, data):
+    result_key = call_cache_key("chat", data)
+    content = get_cache().get(result_key)
+    if content is not None:
+        return content
+
+    batch_key = make_cache_key("batch", data=data)
+    batch_id = get_cache().get(batch_key)
+    if batch_id is None:
+        batch_id = await submit_batch(client, {"request-0": data})
+        get_cache().set(batch_key, batch_id)
+        st.info(f"Submitted batch {batch_id}. Economy mode results can take up to 24 hours, keep this page open.")
+    else:
+        st.info(f"Resuming batch {batch_id}. Economy mode results can take up to 24 hours, keep this page open.")
+
+    try:
+        results = await wait_for_batch(client, batch_id)
+    except RuntimeError:
+        # A finished batch without an answer can't be resumed, so the next run submits a new one
+        get_cache().delete(batch_key)
+        raise
+
+    content = results["request-0"]['choices'][0]['message']['content']
+    get_cache().set(result_key, content)
+    get_cache().delete(batch_key)
+    return content
+
+# Structured output schema for build_story_package, so the reply always has every key
+STORY_PACKAGE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "story_package",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "enhanced": {"type": "string"},
+                "style": {"type": "string"},
+                "segments": {"type": "array", "items": {"type": "string"}}
+            },
+            "required": ["enhanced", "style", "segments"],
+            "additionalProperties": False
+        }
+    }
+}
+
+# Function to enhance the prompt, derive a style and split the story in a single request
+async def build_story_package(client, user_prompt, economy_mode=False):
+    try:
+        data = {
+            "model": "gpt-4o-mini",
+            "response_format": STORY_PACKAGE_FORMAT,
+            "messages": [
+                {"role": "system", "content": (
+                    "Return JSON with keys enhanced, style, segments (5 strings). "
+                    "enhanced: the user's prompt enhanced for a story video. "
+                    "style: a comma-separated list of style and setting descriptions for images. "
+                    "segments: a short story told in at most 5 segments."
+                )},
+                {"role": "user", "content": user_prompt}
+            ]
+        }
+        if economy_mode:
+            content = await batch_chat_completion(client, data)
+        else:
+            content = await _chat_completion(client, data)
+        package = orjson.loads(content)
+        segments = clean_story_segments(str(segment) for segment in package['segments'])
+        return {"enhanced": package['enhanced'], "style": package['style'], "segments": segments}
+    except httpx.HTTPStatusError as http_err:
+        st.warning(f"Error building story package, falling back to separate requests: {http_err}")
+        return None
+    except Exception as e:
+        st.warning(f"Invalid story package, falling back to separate requests: {str(e)}")
+        return None
+
+# Fallback for build_story_package using one request per field
+async def build_story_package_stepwise(client, user_prompt):
+    enhanced_prompt = await enhance_prompt(client, user_prompt)
+    # Style and segments both depend only on the enhanced prompt
+    style_prompt, story_segments = await asyncio.gather(
+        generate_style_prompt(client, enhanced_prompt),
+        generate_story_segments(client, enhanced_prompt)
+    )
+    return {"enhanced": enhanced_prompt, "style": style_prompt, "segments": story_segments}
+
+# Function to create a consistent image prompt. Only the style is trimmed to fit max_length,
+# at a comma where possible, so the segment and the negative prompt always reach the model
+def create_image_prompt(segment, style_prompt, max_length=None):
     negative_prompt = "Make sure there is no text in the image."
-    return f"{style_prompt}, {segment.strip()}, {negative_prompt}"
+    subject = f"{segment.strip()}, {negative_prompt}"
+    if max_length is not None:
+        style_budget = max(max_length - len(subject) - len(", "), 0)
+        if len(style_prompt) > style_budget:
+            style_prompt = style_prompt[:style_budget].rsplit(",", 1)[0].strip()
+    return f"{style_prompt}, {subject}"
+
+# Request an image from DALL-E and return its PNG bytes, sent inline as base64.
+# An image another session already generated for the same request is taken from S3 instead
+@cached("image")
+async def _request_image(client, data):
+    key = asset_key("image", ".png", **data)
+    shared_image = io.BytesIO()
+    if await fetch_shared_asset(key, shared_image):
+        return shared_image.getvalue()
 
-# Function to generate images from a prompt
-def generate_image_from_prompt(prompt):
+    image_data = orjson.loads(await client.post(IMAGE_API_URL, data)).get('data', [])
+    if not image_data:
+        raise ValueError("No images were returned by the API.")
+    image = base64.b64decode(image_data[0]['b64_json'])
+    store_shared_asset(client, key, lambda: io.BytesIO(image), "image/png")
+    return image
+
+# Embed text with OpenAI's embeddings API
+@cached("embedding")
+async def _request_embedding(client, text):
+    data = {"model": "text-embedding-3-small", "input": text}
+    response = orjson.loads(await client.post(EMBEDDINGS_API_URL, data))
+    return response['data'][0]['embedding']
+
+# Semantic cache lookup: map text to an earlier text in the same namespace whose embedding is
+# near-identical, so the exact-match cache answers for it. New texts are remembered
+async def find_similar_text(client, namespace, text, threshold):
+    try:
+        embedding = np.asarray(await _request_embedding(client, text), dtype=np.float32)
+        embedding /= np.linalg.norm(embedding)
+
+        index = get_semantic_index()
+        similar_text = index.find(namespace, embedding, threshold)
+        if similar_text is not None:
+            return similar_text
+        index.add(namespace, text, embedding)
+        return text
+    except Exception as e:
+        st.warning(f"Semantic cache lookup failed, continuing without it: {str(e)}")
+        return text
+
+# Function to generate an image from a prompt
+async def _gen_image(client, semaphore, prompt, draft_mode=False):
     if not prompt.strip():
         st.error("Prompt cannot be empty.")
         return None
     try:
+        model, size, _ = IMAGE_SETTINGS["draft" if draft_mode else "final"]
         data = {
-            "model": "dall-e-3",
+            "model": model,
             "prompt": prompt,
             "n": 1,
-            "size": "1024x1024",
-            "response_format": "url"
+            "size": size,
+            "response_format": "b64_json"
         }
 
-        st.write(f"Sending prompt to OpenAI API: {prompt}")
-
-        response = requests.post(IMAGE_API_URL, headers=HEADERS, json=data)
-        response.raise_for_status()
-        
-        image_data = response.json().get('data', [])
-        if not image_data:
-            st.error("No image URLs were returned by the API.")
-            return None
-        
-        return image_data[0]['url']
+        debug_log(f"Sending prompt to OpenAI API: {prompt}")
+
+        # Only prompts for the same model and size are comparable
+        namespace = f"image:{data['model']}:{data['size']}"
+        data["prompt"] = await find_similar_text(client, namespace, prompt, IMAGE_SIMILARITY_THRESHOLD)
+        async with semaphore:
+            return await _request_image(client, data)
     
-    except requests.exceptions.HTTPError as http_err:
+    except httpx.HTTPStatusError as http_err:
         st.error(f"HTTP error occurred: {http_err}")
         return None
     except Exception as e:
         st.error(f"Error generating image: {str(e)}")
         return None
 
-# Generate voice overlay using OpenAI's TTS API
-def generate_voice_overlay(text, voice="alloy", speed=1):
-    if not text.strip():
+# Generate images for all prompts concurrently, at most IMAGE_CONCURRENCY in flight.
+# Progress is a single counter updated in place rather than one message per image
+async def gen_all_images(client, prompts, draft_mode=False):
+    semaphore = asyncio.Semaphore(IMAGE_CONCURRENCY)
+    status = st.empty()
+    generated = 0
+
+    # Failed images (None) are reported by _gen_image and don't count as generated
+    async def gen_and_count(prompt):
+        nonlocal generated
+        image = await _gen_image(client, semaphore, prompt, draft_mode)
+        if image:
+            generated += 1
+            status.write(f"Generated {generated}/{len(prompts)} images")
+        return image
+
+    return await asyncio.gather(*[gen_and_count(p) for p in prompts])
+
+# Stream speech audio for one piece of text from OpenAI's TTS API into filename.
+# The cache stores the audio as a file, so neither path holds the whole clip in memory
+async def _request_speech(client, data, filename):
+    key = make_cache_key("tts", **data)
+    cached_audio = get_cache().get(key, read=True)
+    if cached_audio is not None:
+        with cached_audio, open(filename, "wb") as f:
+            shutil.copyfileobj(cached_audio, f, STREAM_CHUNK_SIZE)
+        return filename
+
+    # Fall back to the shared S3 copy before paying for the speech again
+    shared_key = asset_key("tts", ".mp3", **data)
+    with open(filename, "wb") as f:
+        found = await fetch_shared_asset(shared_key, f)
+    if not found:
+        await client.post(TTS_API_URL, data, filename=filename)
+        # The upload gets its own copy of the clip, so nothing written to filename later can
+        # end up under the immutable key
+        with open(filename, "rb") as f:
+            speech = f.read()
+        store_shared_asset(client, shared_key, lambda: io.BytesIO(speech), "audio/mpeg")
+
+    with open(filename, "rb") as f:
+        get_cache().set(key, f, read=True)
+    return filename
+
+# Read the duration of a media file in seconds without blocking the event loop
+async def probe_duration(filename):
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", filename,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    output, stderr = await process.communicate()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, "ffprobe", stderr=stderr)
+    return float(output)
+
+# Generate one voiceover clip per story segment concurrently, returning the files and their durations
+async def generate_voice_overlay(client, segments, clip_dir, voice="alloy", speed=1):
+    if not any(segment.strip() for segment in segments):
         st.error("Text for voiceover cannot be empty.")
         return None
     
     try:
-        data = {
-            "model": "tts-1",
-            "input": text,
-            "voice": voice,
-            "speed": speed,
-            "response_format": "mp3"
-        }
+        tts_requests = [
+            {
+                "model": "tts-1",
+                "input": segment,
+                "voice": voice,
+                "speed": speed,
+                "response_format": "mp3"
+            }
+            for segment in segments
+        ]
 
-        st.write(f"Sending data to OpenAI TTS API: {data}")
+        debug_log(f"Sending {len(tts_requests)} segments to OpenAI TTS API with voice {voice}")
 
-        response = requests.post(TTS_API_URL, headers=HEADERS, json=data)
-        response.raise_for_status()
-        
-        voiceover_filename = "voiceover.mp3"
-        with open(voiceover_filename, "wb") as f:
-            f.write(response.content)
-        return upload_to_s3(voiceover_filename)
-    except requests.exceptions.HTTPError as http_err:
+        clip_files = await asyncio.gather(*[
+            _request_speech(client, data, os.path.join(clip_dir, f"voiceover_{idx}.mp3"))
+            for idx, data in enumerate(tts_requests)
+        ])
+        durations = await asyncio.gather(*[probe_duration(clip_filename) for clip_filename in clip_files])
+        return clip_files, durations
+    except httpx.HTTPStatusError as http_err:
         st.error(f"HTTP error occurred: {http_err}")
         return None
+    except FileNotFoundError:
+        st.error(FFMPEG_MISSING_ERROR)
+        return None
     except Exception as e:
         st.error(f"Error generating voiceover: {str(e)}")
         return None
 
-# Function to create subtitles based on text and duration
-def create_subtitles(text, duration):
-    lines = text.split("\n")
-    if not lines:
+# Join voiceover clips into one track; MP3 streams can be joined without re-encoding
+def join_audio_clips(clip_files, output_file="voiceover.mp3"):
+    try:
+        subprocess.run(
+            ["ffmpeg", "-y", "-i", "concat:" + "|".join(clip_files), "-c", "copy", output_file],
+            check=True, capture_output=True
+        )
+        return output_file
+    except subprocess.CalledProcessError as e:
+        st.error(f"Failed to join voiceover clips: {e.stderr.decode(errors='replace')[-1000:]}")
+        return None
+    except FileNotFoundError:
+        st.error(FFMPEG_MISSING_ERROR)
+        return None
+
+# End of each segment in whole milliseconds from the start of the video. Images and
+# subtitle cues both switch at these, so the two never disagree through rounding
+def segment_boundaries_ms(durations):
+    boundaries = []
+    elapsed = 0
+    for duration in durations:
+        elapsed += duration
+        boundaries.append(round(elapsed * 1000))
+    return boundaries
+
+# Function to create subtitles timed to each segment's narration
+def create_subtitles(segments, durations):
+    if not segments:
         st.error("Subtitle text cannot be empty.")
         return []
     
     subtitles = []
-    per_line_duration = duration / len(lines)
-    start_time = 0
+    start_ms = 0
 
-    for line in lines:
-        if not line.strip():
-            continue
-        end_time = start_time + per_line_duration
-        subtitles.append(((start_time, end_time), line.strip()))
-        start_time = end_time
+    # Cues use the same whole-millisecond boundaries as the images in compile_video
+    for segment, end_ms in zip(segments, segment_boundaries_ms(durations)):
+        subtitles.append(((start_ms / 1000, end_ms / 1000), segment.strip()))
+        start_ms = end_ms
 
     return subtitles
 
-# Generate video from images, audio, and subtitles
-def compile_video(images, voiceover_url, subtitles, font_style, output_file="output_video.mp4"):
-    total_duration = 60  # Limit video to 60 seconds
-    image_duration = total_duration / len(images) if images else 0
-    clips = []
+# Format seconds as an SRT timestamp (HH:MM:SS,mmm)
+def _srt_timestamp(seconds):
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    secs, millis = divmod(millis, 1000)
+    return f"{hours:02}:{minutes:02}:{secs:02},{millis:03}"
 
-    for idx, image_url in enumerate(images):
-        img_clip = ImageSequenceClip([image_url], fps=24).set_duration(image_duration)
-        clips.append(img_clip)
+# Write subtitles to an SRT file for ffmpeg's subtitles filter
+def write_srt(subtitles, filename="subtitles.srt"):
+    with open(filename, "w", encoding="utf-8") as f:
+        for idx, ((start_time, end_time), line) in enumerate(subtitles, start=1):
+            f.write(f"{idx}\n{_srt_timestamp(start_time)} --> {_srt_timestamp(end_time)}\n{line}\n\n")
+    return filename
 
-    audio_clip = AudioFileClip(voiceover_url).set_duration(total_duration)
-    video = CompositeVideoClip(clips).set_duration(total_duration).set_audio(audio_clip)
+# ffmpeg options per H.264 encoder: NVIDIA, Apple and Intel hardware encoders in order of
+# preference, then libx264 tuned for a slideshow of still images
+H264_ENCODERS = {
+    "h264_nvenc": ["-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23"],
+    "h264_videotoolbox": ["-b:v", "5M"],
+    "h264_qsv": ["-preset", "veryfast", "-global_quality", "23"],
+    "libx264": ["-preset", "veryfast", "-tune", "stillimage", "-threads", "0"],
+}
 
-    # Create subtitles
-    generator = lambda txt: TextClip(txt, font=font_style, fontsize=24, color='white')
-    subtitle_clip = SubtitlesClip(subtitles, generator)
-    
-    # Combine video and subtitles
-    final_video = CompositeVideoClip([video, subtitle_clip])
-    final_video.write_videofile(output_file, codec="libx264", audio_codec="aac")
+# Encode a fraction of a second of a test pattern; hardware encoders are often built into
+# ffmpeg on machines without the matching GPU or driver
+def _encoder_works(encoder):
+    try:
+        subprocess.run([
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+            *video_encoder_args(encoder), "-f", "null", "-"
+        ], check=True, capture_output=True, timeout=30)
+        return True
+    except (OSError, subprocess.SubprocessError):
+        return False
 
-    return upload_to_s3(output_file)  # Upload final video to S3
+# Pick the preferred working H.264 encoder ffmpeg was built with, checked once per server process
+@st.cache_data
+def detect_h264_encoder():
+    try:
+        encoders = subprocess.check_output(["ffmpeg", "-hide_banner", "-encoders"])
+    except (OSError, subprocess.CalledProcessError):
+        return "libx264"
+    return next((name for name in H264_ENCODERS if name.encode() in encoders and _encoder_works(name)), "libx264")
+
+# ffmpeg video encoder arguments for an encoder in H264_ENCODERS
+def video_encoder_args(encoder):
+    return ["-c:v", encoder, *H264_ENCODERS[encoder]]
+
+# Run an ffmpeg command in cwd, updating progress_bar from its -progress output on stdout
+def run_ffmpeg_with_progress(command, total_duration, progress_bar, cwd=None):
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    # stderr is drained on a worker thread so it can't fill up and stall ffmpeg
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        stderr_future = executor.submit(process.stderr.read)
+        for line in process.stdout:
+            key, _, value = line.decode().strip().partition("=")
+            if key == "out_time_us" and value.isdigit():
+                progress_bar.progress(min(int(value) / 1000000 / total_duration, 1.0))
+        returncode = process.wait()
+        stderr = stderr_future.result()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+
+# Write the images into work_dir with an ffconcat list that shows each one until its segment's
+# whole-millisecond boundary. The concat demuxer ignores the last entry's duration, so the last
+# image is listed once more to close it
+def write_concat_list(images, durations, work_dir, filename="images.txt"):
+    lines = ["ffconcat version 1.0"]
+    start_ms = 0
+    for idx, (image, end_ms) in enumerate(zip(images, segment_boundaries_ms(durations))):
+        with open(os.path.join(work_dir, f"image_{idx}.png"), "wb") as f:
+            f.write(image)
+        lines += [f"file 'image_{idx}.png'", f"duration {(end_ms - start_ms) / 1000}"]
+        start_ms = end_ms
+    lines.append(f"file 'image_{len(images) - 1}.png'")
+    with open(os.path.join(work_dir, filename), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return filename
+
+# Generate video from images, audio, and subtitles with a single ffmpeg invocation
+def compile_video(images, voiceover_file, durations, subtitles, font_style, output_file="output_video.mp4"):
+    total_duration = sum(durations)
+
+    # Font choices are PostScript-style names such as "Arial-Bold"
+    font_name, _, weight = font_style.partition("-")
+    subtitle_style = f"FontName={font_name},Bold={-1 if weight == 'Bold' else 0},FontSize=24,PrimaryColour=&H00FFFFFF"
+
+    # Each run gets its own directory for the images, the list and the SRT file; ffmpeg runs
+    # inside it so the filter graph only sees plain relative names
+    with tempfile.TemporaryDirectory() as work_dir:
+        concat_file = write_concat_list(images, durations, work_dir)
+        write_srt(subtitles, os.path.join(work_dir, "subtitles.srt"))
+
+        # scale shrinks the few source frames before they are duplicated, and fps turns them
+        # into evenly spaced frames so subtitles are drawn on every output frame. round=up
+        # switches images on the first frame at or after their boundary, as libass does for cues
+        video_filter = ",".join([
+            f"scale={VIDEO_SIZE}:{VIDEO_SIZE}:flags=lanczos",
+            f"fps={VIDEO_FPS}:round=up",
+            f"subtitles=subtitles.srt:force_style='{subtitle_style}'"
+        ])
+        progress_bar = st.progress(0.0)
+        # A hardware encoder can still fail mid-encode (e.g. out of encoder sessions), so the
+        # software encoder is kept as a fallback
+        for encoder in dict.fromkeys([detect_h264_encoder(), "libx264"]):
+            command = [
+                "ffmpeg", "-y", "-loglevel", "error", "-nostats", "-progress", "pipe:1",
+                "-f", "concat", "-i", concat_file,
+                "-i", os.path.abspath(voiceover_file),
+                "-vf", video_filter,
+                "-pix_fmt", "yuv420p",
+                *video_encoder_args(encoder),
+                "-c:a", "aac",
+                "-t", str(total_duration),
+                # Put the moov atom first so the video starts playing before it is fully downloaded
+                "-movflags", "+faststart",
+                os.path.abspath(output_file)
+            ]
+            try:
+                run_ffmpeg_with_progress(command, total_duration, progress_bar, cwd=work_dir)
+                return output_file
+            except subprocess.CalledProcessError as e:
+                error = e.stderr.decode(errors='replace')[-1000:]
+                if encoder != "libx264":
+                    st.warning(f"{encoder} failed, encoding with libx264 instead: {error}")
+            except FileNotFoundError:
+                st.error(FFMPEG_MISSING_ERROR)
+                return None
+    st.error(f"ffmpeg failed: {error}")
+    return None
+
+# Run the OpenAI part of the pipeline over one shared HTTP client
+async def generate_story_assets(user_prompt, voice_choice, economy_mode=False, draft_mode=False):
+    async with httpx.AsyncClient(
+        http2=True,
+        headers=HEADERS,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS),
+        timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+    ) as session:
+        client = OpenAIClient(session)
+        with st.spinner("Writing your story..."):
+            # A near-identical earlier prompt is reused so its story comes from the cache
+            user_prompt = await find_similar_text(client, "story", user_prompt, STORY_SIMILARITY_THRESHOLD)
+            package = await build_story_package(client, user_prompt, economy_mode=economy_mode)
+            if package is None:
+                package = await build_story_package_stepwise(client, user_prompt)
+            style_prompt = package["style"]
+            story_segments = package["segments"]
+            st.write(f"Enhanced Prompt: {package['enhanced']}")
+            st.write(f"Style Prompt: {style_prompt}")
+            st.write("Generated Story Segments:")
+            for segment in story_segments:
+                st.write(segment)
+
+        _, _, max_prompt_length = IMAGE_SETTINGS["draft" if draft_mode else "final"]
+        prompts = [create_image_prompt(segment, style_prompt, max_prompt_length) for segment in story_segments]
+        # Narration clips live in a directory of their own for this run; only the joined
+        # voiceover outlives it
+        with tempfile.TemporaryDirectory() as clip_dir:
+            with st.spinner(f"Generating {len(prompts)} images and the voiceover..."):
+                # Images and narration both depend only on the segments, so overlap them
+                results, voice_clips = await asyncio.gather(
+                    gen_all_images(client, prompts, draft_mode),
+                    generate_voice_overlay(client, story_segments, clip_dir, voice=voice_choice)
+                )
+
+            # Keep segments, images and narration aligned so each image matches its audio
+            kept = [idx for idx, image in enumerate(results) if image]
+            story_segments = [story_segments[idx] for idx in kept]
+            images = [results[idx] for idx in kept]
+            if not images:
+                st.error("No images were generated. Please check the prompt or try again.")
+            elif len(images) < len(prompts):
+                st.warning(f"Only {len(images)} of {len(prompts)} images were generated.")
+
+            voiceover = None
+            if images and voice_clips:
+                clip_files, durations = voice_clips
+                voiceover_file = join_audio_clips([clip_files[idx] for idx in kept])
+                if voiceover_file:
+                    voiceover = (voiceover_file, [durations[idx] for idx in kept])
+
+        return story_segments, images, voiceover, client.asset_uploads
 
 # Main app interface
 st.title("Story-Driven Video Generator")
+st.sidebar.checkbox("Debug logs", key="debug")
 
 user_prompt = st.text_area("Enter a short story or theme for the video:", "Spooky Haunted Graveyard in Texas")
 voice_choice = st.selectbox("Choose a voice for the narration:", AVAILABLE_VOICES)
 font_choice = st.selectbox("Choose a font style for subtitles:", ["Arial-Bold", "Courier", "Helvetica", "Times-Roman", "Verdana"])
+draft_mode = st.checkbox("Draft mode: faster, cheaper 512x512 images from DALL-E 2")
+economy_mode = st.checkbox("Economy mode: plan the story through the Batch API at half price (can take up to 24 hours)")
 
 if st.button("Generate Video"):
     st.info("Generating story video... Please be patient, this may take a few minutes.")
@@ -225,46 +1056,31 @@ if st.button("Generate Video"):
     if not user_prompt.strip():
         st.error("Please enter a valid story or theme.")
     else:
-        with st.spinner("Enhancing your prompt..."):
-            enhanced_prompt = enhance_prompt(user_prompt)
-            st.write(f"Enhanced Prompt: {enhanced_prompt}")
+        story_segments, images, voiceover, asset_uploads = asyncio.run(generate_story_assets(user_prompt, voice_choice, economy_mode, draft_mode))
 
-        with st.spinner("Generating style prompt..."):
-            style_prompt = generate_style_prompt(enhanced_prompt)
-            st.write(f"Style Prompt: {style_prompt}")
+        if voiceover:
+            voiceover_file, durations = voiceover
+            # The voiceover is final already, so its upload runs while the video encodes
+            uploads = start_uploads([voiceover_file])
+            subtitles = create_subtitles(story_segments, durations)
+            
+            with st.spinner("Compiling video..."):
+                video_file = compile_video(images, voiceover_file, durations, subtitles, font_choice)
+                
+            if video_file:
+                uploads.update(start_uploads([video_file]))
+                # Play and offer the local file right away instead of waiting for S3
+                with open(video_file, "rb") as f:
+                    video_bytes = f.read()
+                st.video(video_bytes)
+                st.download_button("Download Video", data=video_bytes, file_name="output_video.mp4")
+            else:
+                st.error("Video compilation failed. Please try again.")
 
-        with st.spinner("Generating story segments..."):
-            story_segments = generate_story_segments(enhanced_prompt)
-            story_segments = [segment for segment in story_segments if segment]
-            story_segments = story_segments[:5]
-            st.write("Generated Story Segments:")
-            for segment in story_segments:
-                st.write(segment)
-        
-        images = []
-        for segment in story_segments:
-            with st.spinner(f"Generating image for: {segment}"):
-                img_url = generate_image_from_prompt(create_image_prompt(segment, style_prompt))
-                if img_url:
-                    images.append(img_url)
-                else:
-                    st.error("No images were generated. Please check the prompt or try again.")
-                    break
-        
-        if len(images) > 0:
-            with st.spinner("Generating voiceover..."):
-                voiceover_url = generate_voice_overlay("\n".join(story_segments), voice=voice_choice)
-
-                if voiceover_url:
-                    subtitles = create_subtitles("\n".join(story_segments), 60)
-                    
-                    with st.spinner("Compiling video..."):
-                        video_url = compile_video(images, voiceover_url, subtitles, font_choice)
-                        
-                        if video_url:
-                            st.video(video_url)
-                            
-                            with open(video_url.split('/')[-1], "rb") as f:
-                                st.download_button("Download Video", data=f, file_name="output_video.mp4")
-                        else:
-                            st.error("Video compilation failed. Please try again.")
+            with st.spinner("Uploading to S3..."):
+                for filename, future in uploads.items():
+                    finish_upload(filename, future)
+
+        # Newly generated images and speech finish uploading to the shared S3 tier last
+        with st.spinner("Sharing generated assets..."):
+            finish_shared_assets(asset_uploads)